@@ -19,6 +19,14 @@ import math
 import cv2
 import numpy as np
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+_EYE3 = np.eye(3)
+_EYE3.setflags(write=False)
+
 
 def random_perspective(
         img,
@@ -34,57 +42,73 @@ def random_perspective(
     height = img.shape[0] + border[0] * 2
     width = img.shape[1] + border[1] * 2
 
-    # Center
-    C = np.eye(3)
-    C[0, 2] = -img.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -img.shape[0] / 2  # y translation (pixels)
-
     # Rotation and Scale
-    R = np.eye(3)
     a = random.uniform(-degrees, degrees)
     s = random.uniform(scale[0], scale[1])
-    R[:2] = cv2.getRotationMatrix2D(angle=a, center=(0, 0), scale=s)
 
     # Shear
-    S = np.eye(3)
-    S[0, 1] = math.tan(random.uniform(-shear, shear) * math.pi / 180)
-    S[1, 0] = math.tan(random.uniform(-shear, shear) * math.pi / 180)
+    shear_x = random.uniform(-shear, shear)
+    shear_y = random.uniform(-shear, shear)
 
     # Translation
-    T = np.eye(3)
-    T[0, 2] = (random.uniform(0.5 - translate, 0.5 + translate) * width)  # x translation (pixels)
-    T[1, 2] = (random.uniform(0.5 - translate, 0.5 + translate) * height)  # y translation (pixels)
+    tx = random.uniform(0.5 - translate, 0.5 + translate) * width  # x translation (pixels)
+    ty = random.uniform(0.5 - translate, 0.5 + translate) * height  # y translation (pixels)
+
+    # decided from the draws themselves, M is only built when the image changes
+    changed = (border[0] != 0 or border[1] != 0 or a != 0 or s != 1 or shear_x != 0 or shear_y != 0 or
+               tx != img.shape[1] / 2 or ty != img.shape[0] / 2)
+    if changed:
+        # M = T @ S @ R @ C written out in closed form, R follows cv2.getRotationMatrix2D
+        ca = s * math.cos(a * math.pi / 180)
+        sa = s * math.sin(a * math.pi / 180)
+        shx = math.tan(shear_x * math.pi / 180)
+        shy = math.tan(shear_y * math.pi / 180)
+        cx = img.shape[1] / 2  # center of the source image (pixels)
+        cy = img.shape[0] / 2
+        m00 = ca - shx * sa
+        m01 = sa + shx * ca
+        m10 = shy * ca - sa
+        m11 = shy * sa + ca
+        M = np.array([
+            [m00, m01, tx - (m00 * cx + m01 * cy)],
+            [m10, m11, ty - (m10 * cx + m11 * cy)],
+        ])
 
-    # Combined rotation matrix
-    M = T @ S @ R @ C  # order of operations (right to left) is IMPORTANT
-
-    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
         if perspective:
+            M = np.vstack((M, _EYE3[2]))
             img = cv2.warpPerspective(
                 img, M, dsize=(width, height), borderValue=(114, 114, 114)
             )
         else:  # affine
             img = cv2.warpAffine(
-                img, M[:2], dsize=(width, height), borderValue=(114, 114, 114)
+                img, M, dsize=(width, height), borderValue=(114, 114, 114)
             )
+    else:
+        M = _EYE3
 
     # Transform label coordinates
     n = len(targets)
     if n:
-        xy = np.ones((n * 4, 3))
-        xy[:, :2] = targets[:, [0, 1, 2, 3, 0, 3, 2, 1]].reshape(
+        xy = targets[:, [0, 1, 2, 3, 0, 3, 2, 1]].reshape(
             n * 4, 2
-        )
-        xy = xy @ M.T
+        )  # x1y1, x2y2, x1y2, x2y1
         if perspective:
+            xy = np.concatenate((xy, np.ones((n * 4, 1))), axis=1) @ M.T
             xy = (xy[:, :2] / xy[:, 2:3]).reshape(n, 8)
-        else:
-            xy = xy[:, :2].reshape(n, 8)
+        else:  # affine, written out to skip the matmul
+            new_x = M[0, 0] * xy[:, 0] + M[0, 1] * xy[:, 1] + M[0, 2]
+            new_y = M[1, 0] * xy[:, 0] + M[1, 1] * xy[:, 1] + M[1, 2]
+            xy = np.stack((new_x, new_y), axis=1).reshape(n, 8)
 
         # create new boxes
-        x = xy[:, [0, 2, 4, 6]]
-        y = xy[:, [1, 3, 5, 7]]
-        xy = np.concatenate((x.min(1), y.min(1), x.max(1), y.max(1))).reshape(4, n).T
+        x = xy[:, 0::2]
+        y = xy[:, 1::2]
+        new_boxes = np.empty((n, 4), dtype=xy.dtype)
+        np.min(x, axis=1, out=new_boxes[:, 0])
+        np.min(y, axis=1, out=new_boxes[:, 1])
+        np.max(x, axis=1, out=new_boxes[:, 2])
+        np.max(y, axis=1, out=new_boxes[:, 3])
+        xy = new_boxes
 
         # clip boxes
         xy[:, [0, 2]] = xy[:, [0, 2]].clip(0, width)
@@ -102,16 +126,23 @@ def box_candidates(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.2):
     # box1(4,n), box2(4,n)
     # Compute candidate boxes which include following 5 things:
     # box1 before augment, box2 after augment, wh_thr (pixels), aspect_ratio_thr, area_ratio
+    # ratio tests are multiplied out so no division is needed
+    if numba is not None:
+        return _box_candidates_kernel(box1, box2, wh_thr, ar_thr, area_thr)
     w1, h1 = box1[2] - box1[0], box1[3] - box1[1]
     w2, h2 = box2[2] - box2[0], box2[3] - box2[1]
-    ar = np.maximum(w2 / (h2 + 1e-16), h2 / (w2 + 1e-16))  # aspect ratio
-    return (w2 > wh_thr) & (h2 > wh_thr) & (w2 * h2 / (w1 * h1 + 1e-16) > area_thr) & (ar < ar_thr)  # candidates
+    return np.logical_and.reduce([
+        w2 > wh_thr,
+        h2 > wh_thr,
+        w2 * h2 > area_thr * (w1 * h1 + 1e-16),  # area ratio
+        w2 < ar_thr * (h2 + 1e-16),  # aspect ratio
+        h2 < ar_thr * (w2 + 1e-16),
+    ])  # candidates
 
 
 def augment_hsv(img, hgain=0.015, sgain=0.7, vgain=0.4):
     """ hsv augment """
     r = np.random.uniform(-1, 1, 3) * [hgain, sgain, vgain] + 1  # random gains
-    hue, sat, val = cv2.split(cv2.cvtColor(img, cv2.COLOR_BGR2HSV))
     dtype = img.dtype
 
     x = np.arange(0, 256, dtype=np.int16)
@@ -119,16 +150,17 @@ def augment_hsv(img, hgain=0.015, sgain=0.7, vgain=0.4):
     lut_sat = np.clip(x * r[1], 0, 255).astype(dtype)
     lut_val = np.clip(x * r[2], 0, 255).astype(dtype)
 
-    img_hsv = cv2.merge(
-        (cv2.LUT(hue, lut_hue), cv2.LUT(sat, lut_sat), cv2.LUT(val, lut_val))
-    ).astype(dtype)
-    cv2.cvtColor(img_hsv, cv2.COLOR_HSV2BGR, dst=img)
+    # convert, remap all three channels with one LUT and convert back, in place
+    lut = np.stack((lut_hue, lut_sat, lut_val), axis=-1).reshape(256, 1, 3)
+    cv2.cvtColor(img, cv2.COLOR_BGR2HSV, dst=img)
+    cv2.LUT(img, lut, dst=img)
+    cv2.cvtColor(img, cv2.COLOR_HSV2BGR, dst=img)
 
 
 def _mirror(image, boxes, prob=0.5):
     _, width, _ = image.shape
     if random.random() < prob:
-        image = image[:, ::-1]
+        image = cv2.flip(image, 1)
         boxes[:, 0::2] = width - boxes[:, 2::-2]
     return image, boxes
 
@@ -136,22 +168,103 @@ def _mirror(image, boxes, prob=0.5):
 def preproc(img, input_size, swap=(2, 0, 1)):
     """ padding image and transpose dim """
     if len(img.shape) == 3:
-        padded_img = np.ones((input_size[0], input_size[1], 3), dtype=np.uint8) * 114
+        padded_img = np.full((input_size[0], input_size[1], 3), 114, dtype=np.uint8)
     else:
-        padded_img = np.ones(input_size, dtype=np.uint8) * 114
+        padded_img = np.full(input_size, 114, dtype=np.uint8)
     r = min(input_size[0] / img.shape[0], input_size[1] / img.shape[1])
-    resized_img = cv2.resize(
-        img,
-        (int(img.shape[1] * r), int(img.shape[0] * r)),
-        interpolation=cv2.INTER_LINEAR,
-    ).astype(np.uint8)
-    padded_img[: int(img.shape[0] * r), : int(img.shape[1] * r)] = resized_img
-
-    padded_img = padded_img.transpose(swap)
-    padded_img = np.ascontiguousarray(padded_img, dtype=np.float32)
+    resized_h, resized_w = int(img.shape[0] * r), int(img.shape[1] * r)
+    if img.dtype == np.uint8:
+        cv2.resize(
+            img,
+            (resized_w, resized_h),
+            dst=padded_img[:resized_h, :resized_w],
+            interpolation=cv2.INTER_LINEAR,
+        )
+    else:  # cv2 only writes into dst when the dtypes match
+        padded_img[:resized_h, :resized_w] = cv2.resize(
+            img,
+            (resized_w, resized_h),
+            interpolation=cv2.INTER_LINEAR,
+        ).astype(np.uint8)
+
+    # transpose and cast to float32 in a single copy
+    padded_img = np.ascontiguousarray(padded_img.transpose(swap), dtype=np.float32)
     return padded_img, r
 
 
+if numba is not None:
+    @numba.njit(nogil=True, cache=True)
+    def _in_boxes_kernel(gt, x_centers, y_centers, cr_strides, true_labels, out_all, out_and):
+        """ fused in-box and in-center test for every (gt, anchor) pair, written straight into out_* """
+        half = np.float32(0.5)
+        num_total_anchor = x_centers.shape[0]
+        for m in range(gt.shape[0]):
+            if m >= true_labels:  # padding gts are set False
+                out_all[m, :] = False
+                out_and[m, :] = False
+                continue
+            gt_cx = gt[m, 0]
+            gt_cy = gt[m, 1]
+            half_w = half * gt[m, 2]
+            half_h = half * gt[m, 3]
+            for a in range(num_total_anchor):
+                cx = x_centers[a]
+                cy = y_centers[a]
+                radius = cr_strides[a]
+                # bitwise instead of short-circuit ops keeps the inner loop branchless
+                in_box = ((cx - (gt_cx - half_w) > 0) & ((gt_cx + half_w) - cx > 0) &
+                          (cy - (gt_cy - half_h) > 0) & ((gt_cy + half_h) - cy > 0))
+                in_center = ((cx - (gt_cx - radius) > 0) & ((gt_cx + radius) - cx > 0) &
+                             (cy - (gt_cy - radius) > 0) & ((gt_cy + radius) - cy > 0))
+                out_all[m, a] = in_box | in_center
+                out_and[m, a] = in_box & in_center
+
+    @numba.njit(cache=True)
+    def _box_candidates_kernel(box1, box2, wh_thr, ar_thr, area_thr):
+        """ scalar loop version of box_candidates, n is at most max_labels so this beats ufunc dispatch """
+        n = box1.shape[1]
+        out = np.empty(n, dtype=np.bool_)
+        for i in range(n):
+            w1 = box1[2, i] - box1[0, i]
+            h1 = box1[3, i] - box1[1, i]
+            w2 = box2[2, i] - box2[0, i]
+            h2 = box2[3, i] - box2[1, i]
+            out[i] = (w2 > wh_thr and h2 > wh_thr and w2 * h2 > area_thr * (w1 * h1 + 1e-16) and
+                      w2 < ar_thr * (h2 + 1e-16) and h2 < ar_thr * (w2 + 1e-16))
+        return out
+
+
+def _compute_masks(gt, x_centers, y_centers, cr_strides, true_labels, out_all, out_and):
+    """ fill the in-box-or-center and in-box-and-center masks, the numba path releases the GIL """
+    if numba is not None:
+        _in_boxes_kernel(gt, x_centers, y_centers, cr_strides, true_labels, out_all, out_and)
+        return
+
+    gt_cx = gt[:, 0:1]  # (M, 1)
+    gt_cy = gt[:, 1:2]
+    gt_half_w = 0.5 * gt[:, 2:3]
+    gt_half_h = 0.5 * gt[:, 3:4]
+
+    b_l = x_centers - (gt_cx - gt_half_w)
+    b_r = (gt_cx + gt_half_w) - x_centers
+    b_t = y_centers - (gt_cy - gt_half_h)
+    b_b = (gt_cy + gt_half_h) - y_centers
+
+    is_in_boxes = np.minimum(np.minimum(b_l, b_t), np.minimum(b_r, b_b)) > 0.0
+    is_in_boxes[true_labels:, ...] = False
+
+    c_l = x_centers - (gt_cx - cr_strides)
+    c_r = (gt_cx + cr_strides) - x_centers
+    c_t = y_centers - (gt_cy - cr_strides)
+    c_b = (gt_cy + cr_strides) - y_centers
+
+    is_in_centers = np.minimum(np.minimum(c_l, c_r), np.minimum(c_t, c_b)) > 0.0
+    is_in_centers[true_labels:, ...] = False  # padding gts are set False
+
+    np.logical_or(is_in_boxes, is_in_centers, out=out_all)
+    np.logical_and(is_in_boxes, is_in_centers, out=out_and)
+
+
 class TrainTransform:
     """ image transform for training """
 
@@ -171,6 +284,7 @@ class TrainTransform:
         self.grid_size = [(self.input_size[0] / x) * (self.input_size[1] / x) for x in
                           self.strides]
         self.num_total_anchor = int(sum(self.grid_size))
+        self._build_grid()
 
     def __call__(self, image, targets, input_dim):
         """ Tran transform call """
@@ -179,8 +293,8 @@ class TrainTransform:
         if not boxes.size:
             targets = np.zeros((self.max_labels, 5), dtype=np.float32)
             image, r_o = preproc(image, input_dim)
-            is_in_boxes_all = np.zeros((self.max_labels, self.num_total_anchor)).astype(np.bool_)
-            is_in_boxes_and_center = np.zeros((self.max_labels, self.num_total_anchor)).astype(np.bool_)
+            is_in_boxes_all = np.zeros((self.max_labels, self.num_total_anchor), dtype=np.bool_)
+            is_in_boxes_and_center = np.zeros((self.max_labels, self.num_total_anchor), dtype=np.bool_)
             return image, targets, is_in_boxes_all, is_in_boxes_and_center
         image_o = image.copy()
         targets_o = targets.copy()
@@ -208,100 +322,47 @@ class TrainTransform:
         labels_t = np.expand_dims(labels_t, 1)
 
         targets_t = np.hstack((labels_t, boxes_t))
-        padded_labels = np.zeros((self.max_labels, 5))
+        padded_labels = np.zeros((self.max_labels, 5), dtype=np.float32)
         true_labels = len(targets_t)
 
-        padded_labels[range(len(targets_t))[: self.max_labels]] = targets_t[: self.max_labels]
-        padded_labels = np.ascontiguousarray(padded_labels, dtype=np.float32)
+        padded_labels[: true_labels] = targets_t[: self.max_labels]
         gt_bboxes_per_image = padded_labels[:, 1:5]
         is_in_boxes_all, is_in_boxes_and_center = self.get_in_boxes_info(gt_bboxes_per_image, true_labels)
-        is_in_boxes_all = is_in_boxes_all.any(1).reshape((-1, 1)) * is_in_boxes_all.any(0).reshape((1, -1))
+        is_in_boxes_all = np.outer(is_in_boxes_all.any(1), is_in_boxes_all.any(0))
         return image_t, padded_labels, is_in_boxes_all, is_in_boxes_and_center
 
+    def _build_grid(self):
+        """ build the anchor grid once, strides and input size are fixed after init """
+        x_shifts = []  # (6400,) (1600,) (400,) --> (8400,)
+        y_shifts = []
+        expanded_strides = []
+        for _stride in self.strides:
+            grid_h = int(self.input_size[0] / _stride)
+            grid_w = int(self.input_size[1] / _stride)
+            x_shifts.append(np.tile(np.arange(grid_w, dtype=np.float32), grid_h))
+            y_shifts.append(np.repeat(np.arange(grid_h, dtype=np.float32), grid_w))
+            expanded_strides.append(np.full(grid_w * grid_h, _stride, dtype=np.float32))
+        self._x_shifts = np.concatenate(x_shifts)[None]  # (1, num_total_anchor)
+        self._y_shifts = np.concatenate(y_shifts)[None]
+        self._expanded_strides = np.concatenate(expanded_strides)[None]
+        # anchor centers, (1, num_total_anchor)
+        self._x_centers = (self._x_shifts + 0.5) * self._expanded_strides
+        self._y_centers = (self._y_shifts + 0.5) * self._expanded_strides
+        # half size of the center sampling window around each anchor
+        center_radius = 2.5
+        self._cr_strides = center_radius * self._expanded_strides
+
     def get_grid(self):
         """ get grid in each image """
-        grid_size_x = []
-        grid_size_y = []
-        x_shifts = []  # (1, 6400) (1,1600) (1, 400) -->(1, 8400)
-        y_shifts = []  # (1, 6400) (1,1600) (1, 400)
-        expanded_strides = []  # (1, 6400) (1,1600) (1, 400)
-        for _stride in self.strides:
-            grid_size_x.append(int(self.input_size[0] / _stride))
-            grid_size_y.append(int(self.input_size[1] / _stride))
-        for i in range(len(grid_size_x)):
-            xv, yv = np.meshgrid(np.arange(0, grid_size_y[i]), np.arange(0, grid_size_x[i]))
-            grid = np.stack((xv, yv), 2).reshape(1, 1, grid_size_x[i], grid_size_y[i], 2)
-            grid = grid.reshape(1, -1, 2)
-            x_shifts.append(grid[:, :, 0])
-            y_shifts.append(grid[:, :, 1])
-            this_stride = np.zeros((1, grid.shape[1]))
-            this_stride.fill(self.strides[i])
-            this_stride = this_stride.astype(np.float32)
-            expanded_strides.append(this_stride)
-        x_shifts = np.concatenate(x_shifts, axis=1)
-        y_shifts = np.concatenate(y_shifts, axis=1)
-        expanded_strides = np.concatenate(expanded_strides, axis=1)
-        return x_shifts, y_shifts, expanded_strides
+        return self._x_shifts, self._y_shifts, self._expanded_strides
 
     def get_in_boxes_info(self, gt_bboxes_per_image, true_lables):
         """ get the pre in-center and in-box info for each image """
-        x_shifts, y_shifts, expanded_strides = self.get_grid()
-        num_total_anchor = x_shifts.shape[1]
-        expanded_strides = expanded_strides[0]
-        x_shifts_per_image = x_shifts[0] * expanded_strides
-        y_shifts_per_image = y_shifts[0] * expanded_strides
-
-        x_centers_per_image = np.expand_dims((x_shifts_per_image + 0.5 * expanded_strides), axis=0)
-        x_centers_per_image = np.repeat(x_centers_per_image, self.max_labels, axis=0)
-
-        y_centers_per_image = np.expand_dims((y_shifts_per_image + 0.5 * expanded_strides), axis=0)
-        y_centers_per_image = np.repeat(y_centers_per_image, self.max_labels, axis=0)
-
-        gt_bboxes_per_image_l = np.expand_dims((gt_bboxes_per_image[:, 0] - 0.5 * gt_bboxes_per_image[:, 2]), axis=1)
-        gt_bboxes_per_image_l = np.repeat(gt_bboxes_per_image_l, num_total_anchor, axis=1)
-
-        gt_bboxes_per_image_r = np.expand_dims((gt_bboxes_per_image[:, 0] + 0.5 * gt_bboxes_per_image[:, 2]), axis=1)
-        gt_bboxes_per_image_r = np.repeat(gt_bboxes_per_image_r, num_total_anchor, axis=1)
-
-        gt_bboxes_per_image_t = np.expand_dims((gt_bboxes_per_image[:, 1] - 0.5 * gt_bboxes_per_image[:, 3]), axis=1)
-        gt_bboxes_per_image_t = np.repeat(gt_bboxes_per_image_t, num_total_anchor, axis=1)
-
-        gt_bboxes_per_image_b = np.expand_dims((gt_bboxes_per_image[:, 1] + 0.5 * gt_bboxes_per_image[:, 3]), axis=1)
-        gt_bboxes_per_image_b = np.repeat(gt_bboxes_per_image_b, num_total_anchor, axis=1)
-
-        b_l = x_centers_per_image - gt_bboxes_per_image_l
-        b_r = gt_bboxes_per_image_r - x_centers_per_image
-        b_t = y_centers_per_image - gt_bboxes_per_image_t
-        b_b = gt_bboxes_per_image_b - y_centers_per_image
-
-        bbox_deltas = np.stack([b_l, b_t, b_r, b_b], 2)
-        is_in_boxes = bbox_deltas.min(axis=-1) > 0.0
-        is_in_boxes[true_lables:, ...] = False
-
-        center_radius = 2.5
-        gt_bboxes_per_image_l = np.repeat(np.expand_dims((gt_bboxes_per_image[:, 0]), 1), num_total_anchor, 1) - \
-                                center_radius * np.expand_dims(expanded_strides, 0)
-
-        gt_bboxes_per_image_r = np.repeat(np.expand_dims((gt_bboxes_per_image[:, 0]), 1), num_total_anchor, 1) + \
-                                center_radius * np.expand_dims(expanded_strides, 0)
-
-        gt_bboxes_per_image_t = np.repeat(np.expand_dims((gt_bboxes_per_image[:, 1]), 1), num_total_anchor, 1) - \
-                                center_radius * np.expand_dims(expanded_strides, 0)
-
-        gt_bboxes_per_image_b = np.repeat(np.expand_dims((gt_bboxes_per_image[:, 1]), 1), num_total_anchor, 1) + \
-                                center_radius * np.expand_dims(expanded_strides, 0)
-
-        c_l = x_centers_per_image - gt_bboxes_per_image_l
-        c_r = gt_bboxes_per_image_r - x_centers_per_image
-        c_t = y_centers_per_image - gt_bboxes_per_image_t
-        c_b = gt_bboxes_per_image_b - y_centers_per_image
-
-        center_deltas = np.stack([c_l, c_r, c_t, c_b], 2)
-        is_in_centers = center_deltas.min(axis=-1) > 0.0
-        is_in_centers[true_lables:, ...] = False  # padding gts are set False
-
-        is_in_boxes_all = is_in_boxes | is_in_centers
-        is_in_boxes_and_center = is_in_boxes & is_in_centers
+        gt_bboxes_per_image = np.ascontiguousarray(gt_bboxes_per_image, dtype=np.float32)
+        is_in_boxes_all = np.empty((self.max_labels, self.num_total_anchor), dtype=np.bool_)
+        is_in_boxes_and_center = np.empty((self.max_labels, self.num_total_anchor), dtype=np.bool_)
+        _compute_masks(gt_bboxes_per_image, self._x_centers[0], self._y_centers[0], self._cr_strides[0],
+                       true_lables, is_in_boxes_all, is_in_boxes_and_center)
         return is_in_boxes_all, is_in_boxes_and_center
 
 
@@ -323,16 +384,13 @@ class ValTransform:
 
 
 def xyxy2cxcywh(bboxes):
-    bboxes[:, 2] = bboxes[:, 2] - bboxes[:, 0]
-    bboxes[:, 3] = bboxes[:, 3] - bboxes[:, 1]
-    bboxes[:, 0] = bboxes[:, 0] + bboxes[:, 2] * 0.5
-    bboxes[:, 1] = bboxes[:, 1] + bboxes[:, 3] * 0.5
+    bboxes[:, 2:4] -= bboxes[:, 0:2]
+    bboxes[:, 0:2] += 0.5 * bboxes[:, 2:4]
     return bboxes
 
 
 def xyxy2xywh(bboxes):
-    bboxes[:, 2] = bboxes[:, 2] - bboxes[:, 0]
-    bboxes[:, 3] = bboxes[:, 3] - bboxes[:, 1]
+    bboxes[:, 2:4] -= bboxes[:, 0:2]
     return bboxes
 
 